@@ -10,15 +10,52 @@ import urllib.parse
 import psutil
 import time
 import shutil
-from flask import Flask, request, jsonify, make_response
+import threading
+import cProfile
+import pstats
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, make_response, g, has_request_context
+from subserver import write_index, SubIndex, INDEX_FILE, SUB_ACTIVE, SUB_ON_HOLD, SUB_SUSPENDED, SUB_KEY_MISSING
 
 app = Flask(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json')
 DB_FILE = os.path.join(BASE_DIR, 'users.db')
+UNLIMITED_EXPIRY = '2099-12-31 23:59:59'
+USER_STATUSES = ('active', 'on_hold', 'suspended')
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 200
 BACKUP_FILE = os.path.join(BASE_DIR, 'users.db.backup')
 
+# Outbox worker: pending Outline mutations are retried with a capped backoff
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_CONCURRENCY = 8
+OUTBOX_MAX_ATTEMPTS = 20  # Then the op is dead-lettered (next_attempt NULL) and only shown in /outbox
+outbox_wakeup = threading.Event()
+
+# Subscription snapshot ("sub_snapshot": true in config.json) for subserver.py
+SNAPSHOT_REFRESH_SECONDS = 300
+SNAPSHOT_DEBOUNCE_SECONDS = 1
+snapshot_wakeup = threading.Event()
+snapshot_state = {'last_build': None, 'entries': None, 'outline_ok': None, 'last_error': None, 'last_error_at': None}
+
+# Single-flight: concurrent identical Outline GETs share one request and its parsed result
+inflight_gets = {}
+inflight_lock = threading.Lock()
+api_stats = {'get_calls': 0, 'get_fetches': 0, 'get_deduplicated': 0}
+
+# Tracing: requests slower than 'slow_request_ms' (config.json) are appended to SLOW_LOG_FILE
+SLOW_LOG_FILE = os.path.join(BASE_DIR, 'slow_requests.log')
+DEFAULT_SLOW_REQUEST_MS = 500
+trace_settings = {'slow_request_ms': DEFAULT_SLOW_REQUEST_MS}  # Loaded once at startup
+PROFILE_FILE = os.path.join(BASE_DIR, 'requests.prof')
+profile_state = {'remaining': 0, 'profiled': 0, 'stats': None}
+profile_state_lock = threading.Lock()
+profile_slot = threading.Lock()  # cProfile can only profile one request at a time
+
 def load_config():
     with open(CONFIG_FILE, 'r') as f:
         return json.load(f)
@@ -27,6 +64,38 @@ def generate_token(length=10):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choice(chars) for _ in range(length))
 
+# --- TRACING ---
+# Each request collects time per phase in g.spans: 'db' (connect/queries/commit),
+# 'outline' (call_api incl. retries) and 'render' (everything else: Python work + response building).
+
+@contextmanager
+def trace_span(phase):
+    start = time.perf_counter()
+    try: yield
+    finally:
+        if has_request_context() and 'spans' in g:
+            g.spans[phase] = g.spans.get(phase, 0.0) + time.perf_counter() - start
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        with trace_span('db'): return super().execute(*args)
+    def executemany(self, *args):
+        with trace_span('db'): return super().executemany(*args)
+    def fetchone(self):
+        with trace_span('db'): return super().fetchone()
+    def fetchall(self):
+        with trace_span('db'): return super().fetchall()
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+    def commit(self):
+        with trace_span('db'): return super().commit()
+
+def db_connect():
+    with trace_span('db'):
+        return sqlite3.connect(DB_FILE, factory=TracedConnection)
+
 def init_db():
     if os.path.exists(DB_FILE):
         try: shutil.copy(DB_FILE, BACKUP_FILE)
@@ -37,10 +106,43 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS users 
                  (token TEXT PRIMARY KEY, key_id TEXT, name TEXT, expiry_date TEXT, 
                   status TEXT DEFAULT 'active', data_limit INTEGER DEFAULT 0, initial_duration TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox 
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, key_id TEXT, op TEXT, payload TEXT, 
+                  attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0, last_error TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_key ON outbox (key_id, op)")
+    # NOCASE so that case-insensitive 'name LIKE "abc%"' prefix searches can use the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users (name COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_expiry ON users (expiry_date)")
     conn.commit()
     conn.close()
 
-def call_api(method, endpoint, data=None):
+def call_api(method, endpoint, data=None, missing_ok=False):
+    # missing_ok: a 404 counts as success (the key is already gone from Outline)
+    with trace_span('outline'):
+        if method == 'GET': return shared_get(endpoint)
+        return _call_api(method, endpoint, data, missing_ok)
+
+def shared_get(endpoint):
+    # Followers wait for the in-flight leader; the parsed JSON is shared, so callers must not mutate it
+    with inflight_lock:
+        api_stats['get_calls'] += 1
+        flight = inflight_gets.get(endpoint)
+        is_leader = flight is None
+        if is_leader:
+            flight = inflight_gets[endpoint] = {'done': threading.Event(), 'result': None}
+            api_stats['get_fetches'] += 1
+        else:
+            api_stats['get_deduplicated'] += 1
+    if not is_leader:
+        flight['done'].wait()
+        return flight['result']
+    try: flight['result'] = _call_api('GET', endpoint)
+    finally:
+        with inflight_lock: del inflight_gets[endpoint]
+        flight['done'].set()
+    return flight['result']
+
+def _call_api(method, endpoint, data=None, missing_ok=False):
     conf = load_config()
     url = f"{conf['outline_api']}/{endpoint}"
     max_retries = 3
@@ -49,8 +151,9 @@ def call_api(method, endpoint, data=None):
             # Note: verify=False is used because Outline typically uses self-signed certs.
             # In a strictly internal network, this is acceptable.
             response = requests.request(method, url, json=data, verify=False, timeout=10)
-            if 200 <= response.status_code < 300: return response.json()
-            if response.status_code == 404 and method == 'DELETE': return {}
+            # Outline answers most PUT/DELETE calls with 204 and an empty body
+            if 200 <= response.status_code < 300: return response.json() if response.content else {}
+            if response.status_code == 404 and (method == 'DELETE' or missing_ok): return {}
         except requests.exceptions.RequestException:
             if attempt < max_retries - 1:
                 time.sleep(1)
@@ -58,14 +161,175 @@ def call_api(method, endpoint, data=None):
             else: return None
     return None
 
+# --- OUTBOX ---
+# Key mutations are recorded in the 'outbox' table inside the same transaction as the
+# user row change, then applied to Outline by a background worker. Ops:
+#   name       -> PUT access-keys/<id>/name         payload: {"name": ...}
+#   data_limit -> PUT/DELETE access-keys/<id>/data-limit  payload: {"bytes": N} (0 = remove limit)
+
+def enqueue_outbox(c, key_id, op, payload):
+    # Caller commits, then wakes the worker with outbox_wakeup.set()
+    c.execute("INSERT INTO outbox (key_id, op, payload) VALUES (?, ?, ?)", (key_id, op, json.dumps(payload)))
+
+def apply_outbox_op(key_id, op, payload):
+    if op == 'name':
+        return call_api('PUT', f'access-keys/{key_id}/name', {'name': payload['name']}, missing_ok=True) is not None
+    if op == 'data_limit':
+        if payload['bytes'] == 0:
+            return call_api('DELETE', f'access-keys/{key_id}/data-limit') is not None
+        return call_api('PUT', f'access-keys/{key_id}/data-limit', {'limit': {'bytes': payload['bytes']}},
+                        missing_ok=True) is not None
+    return True  # Unknown op: drop it instead of retrying forever
+
+def coalesce_outbox(c):
+    # Only the latest op per (key_id, op) matters: older data-limit/name changes are superseded
+    c.execute('''DELETE FROM outbox WHERE id NOT IN 
+                 (SELECT MAX(id) FROM outbox GROUP BY key_id, op)''')
+    return c.rowcount
+
+def process_outbox():
+    conn = db_connect()
+    c = conn.cursor()
+    coalesce_outbox(c)
+    conn.commit()
+    c.execute("SELECT id, key_id, op, payload, attempts FROM outbox WHERE next_attempt <= ? ORDER BY id", (time.time(),))
+    pending = c.fetchall()
+
+    # Ops queued after the coalesce above can still duplicate a (key_id, op); keep only the newest
+    latest = {}
+    for row in pending: latest[(row[1], row[2])] = row
+    superseded = [(row[0],) for row in pending if latest[(row[1], row[2])] is not row]
+    c.executemany("DELETE FROM outbox WHERE id=?", superseded)
+    conn.commit()  # Release the write lock before any Outline calls
+    by_key = {}
+    for row in sorted(latest.values()): by_key.setdefault(row[1], []).append(row)
+
+    def run_key(rows):
+        # Ops of one key go out in id order; only different keys run in parallel
+        results = []
+        for op_id, key_id, op, payload, attempts in rows:
+            try:
+                ok = apply_outbox_op(key_id, op, json.loads(payload))
+                results.append((ok, None if ok else 'Outline API Error'))
+            except Exception as e: results.append((False, str(e)))
+        return results
+
+    with ThreadPoolExecutor(max_workers=OUTBOX_CONCURRENCY) as pool:
+        key_results = list(pool.map(run_key, by_key.values()))
+    for rows, results in zip(by_key.values(), key_results):
+        for (op_id, key_id, op, payload, attempts), (ok, error) in zip(rows, results):
+            if ok:
+                # A newer op for the same key may have been queued meanwhile; only drop this one
+                c.execute("DELETE FROM outbox WHERE id=?", (op_id,))
+            else:
+                backoff = min(OUTBOX_MAX_BACKOFF, 2 ** attempts)
+                next_attempt = time.time() + backoff if attempts + 1 < OUTBOX_MAX_ATTEMPTS else None
+                c.execute("UPDATE outbox SET attempts=attempts+1, next_attempt=?, last_error=? WHERE id=?",
+                          (next_attempt, error, op_id))
+    conn.commit()
+    conn.close()
+    return len(pending)
+
+def outbox_worker():
+    while True:
+        outbox_wakeup.wait(OUTBOX_POLL_SECONDS)
+        outbox_wakeup.clear()
+        try: process_outbox()
+        except Exception: time.sleep(OUTBOX_POLL_SECONDS)
+
+def start_outbox_worker():
+    t = threading.Thread(target=outbox_worker, name='outbox-worker', daemon=True)
+    t.start()
+    outbox_wakeup.set()  # Flush anything left over from the previous run
+    return t
+
+# --- SUBSCRIPTION SNAPSHOT ---
+# Token -> rendered subscription text, written to a memory-mappable index (see subserver.py).
+# Rebuilt at startup (config changes restart the service), after user changes and periodically.
+
+def build_sub_snapshot():
+    conf = load_config()
+    index_path = conf.get('snapshot_file') or INDEX_FILE
+    keys = call_api('GET', 'access-keys')
+    # Status, expiry and deletions always come from the DB; only the bodies need Outline.
+    # During an outage the bodies are carried over from the previous index.
+    previous = None if keys else SubIndex(index_path)
+    url_map = {k['id']: k['accessUrl'] for k in keys.get('accessKeys', [])} if keys else {}
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("SELECT token, key_id, name, status, expiry_date FROM users")
+    users = c.fetchall()
+    conn.close()
+
+    status_codes = {'on_hold': SUB_ON_HOLD, 'suspended': SUB_SUSPENDED}
+    entries = []
+    for token, key_id, name, status, expiry_str in users:
+        expiry_ts = 0
+        if expiry_str:
+            try: expiry_ts = time.mktime(time.strptime(expiry_str, '%Y-%m-%d %H:%M:%S'))
+            except: pass
+        code = status_codes.get(status, SUB_ACTIVE)
+        access_url = url_map.get(key_id)
+        body = render_sub_text(conf, access_url, name) if access_url is not None else None
+        if body is None and previous is not None:
+            found = previous.lookup(token)
+            if found and found[0] != SUB_KEY_MISSING and found[2]: body = found[2].decode()
+        if body is None:
+            if code != SUB_SUSPENDED: code = SUB_KEY_MISSING
+            body = ""
+        entries.append((token, code, expiry_ts, body, sub_filename(name, token)))
+    count = write_index(index_path, entries)
+    snapshot_state.update({'last_build': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                           'entries': count, 'outline_ok': bool(keys), 'last_error': None, 'last_error_at': None})
+    return count
+
+def snapshot_worker():
+    while True:
+        snapshot_wakeup.wait(SNAPSHOT_REFRESH_SECONDS)
+        time.sleep(SNAPSHOT_DEBOUNCE_SECONDS)  # Fold bursts of changes into one rebuild
+        snapshot_wakeup.clear()
+        try: build_sub_snapshot()
+        except Exception as e:
+            snapshot_state.update({'last_error': f"{type(e).__name__}: {e}",
+                                   'last_error_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+
+def start_snapshot_worker():
+    t = threading.Thread(target=snapshot_worker, name='snapshot-worker', daemon=True)
+    t.start()
+    snapshot_wakeup.set()
+    return t
+
+def render_sub_text(conf, access_url, db_name):
+    base = access_url.split('?')[0]
+    # Regex Fix: Removed space in group name (?P<u > -> ?P<u>)
+    match = re.match(r'ss://(?P<u>[^@]+)@(?P<h>[^:]+):(?P<p>\d+)', base)
+    if not match: return access_url
+    final_port = conf['force_port'] if conf['force_port'] else match.group('p')
+    base_suffix = conf['custom_suffix'].split('#')[0]
+    encoded_name = urllib.parse.quote(db_name)
+    return f"ss://{match.group('u')}@{conf['tunnel_address']}:{final_port}{base_suffix}#{encoded_name}"
+
+def sub_filename(db_name, token):
+    # Sanitize Filename for Header Injection Protection
+    safe_filename = re.sub(r'[^\w\-. ]', '', db_name).strip()
+    return safe_filename if safe_filename else f"outline-{token}"
+
+def like_escape(text):
+    # Escape LIKE wildcards; pair with ESCAPE '\'
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+def duration_to_hours(duration_str):
+    # '30d' -> 720, '5h'/'5' -> 5, invalid -> None ('0' = unlimited is handled by callers)
+    match = re.match(r'^(\d+)([dh]?)$', str(duration_str).strip().lower())
+    if not match: return None
+    value = int(match.group(1))
+    return value * 24 if match.group(2) == 'd' else value
+
 def calculate_expiry_date(duration_str, base_date=None):
     s = str(duration_str).strip().lower()
-    if s == '0': return '2099-12-31 23:59:59'
-    match = re.match(r'^(\d+)([dh]?)$', s)
-    if not match: return None 
-    value = int(match.group(1))
-    unit = match.group(2)
-    hours_to_add = value * 24 if unit == 'd' else value
+    if s == '0': return UNLIMITED_EXPIRY
+    hours_to_add = duration_to_hours(s)
+    if hours_to_add is None: return None
     start_time = base_date if base_date else datetime.datetime.now()
     return (start_time + datetime.timedelta(hours=hours_to_add)).strftime('%Y-%m-%d %H:%M:%S')
 
@@ -75,8 +339,75 @@ def check_local_access():
         return False
     return True
 
+# --- REQUEST HOOKS ---
+
+def load_trace_settings():
+    # Config changes restart the service, so the threshold is read once; null disables the slow log
+    try:
+        value = load_config().get('slow_request_ms', DEFAULT_SLOW_REQUEST_MS)
+        trace_settings['slow_request_ms'] = None if value is None else float(value)
+    except: trace_settings['slow_request_ms'] = DEFAULT_SLOW_REQUEST_MS
+
+@app.before_request
+def start_request_trace():
+    g.spans = {}
+    g.trace_start = time.perf_counter()
+    if profile_state['remaining'] > 0 and request.endpoint != 'profile_requests' and profile_slot.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request_trace(response):
+    if 'trace_start' not in g: return response
+    total = time.perf_counter() - g.trace_start
+    db_time = g.spans.get('db', 0.0)
+    outline_time = g.spans.get('outline', 0.0)
+    phases = {"db": db_time, "outline": outline_time, "render": max(0.0, total - db_time - outline_time)}
+    # Operator-only: public /getsub callers must not see internal latencies
+    if check_local_access():
+        response.headers['Server-Timing'] = ', '.join(f"{k};dur={v * 1000:.1f}" for k, v in phases.items())
+
+    threshold = trace_settings['slow_request_ms']
+    if threshold is not None and total * 1000 >= threshold:
+        entry = {"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), "method": request.method,
+                 "path": request.path, "status": response.status_code, "total_ms": round(total * 1000, 1)}
+        entry.update({f"{k}_ms": round(v * 1000, 1) for k, v in phases.items()})
+        try:
+            with open(SLOW_LOG_FILE, 'a') as f: f.write(json.dumps(entry) + "\n")
+        except OSError: pass
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc=None):
+    profiler = g.pop('profiler', None)
+    if profiler is None: return
+    profiler.disable()
+    with profile_state_lock:
+        if profile_state['stats'] is None: profile_state['stats'] = pstats.Stats(profiler)
+        else: profile_state['stats'].add(profiler)
+        profile_state['profiled'] += 1
+        profile_state['remaining'] = max(0, profile_state['remaining'] - 1)
+        if profile_state['remaining'] == 0:
+            profile_state['stats'].dump_stats(PROFILE_FILE)
+            profile_state['stats'] = None
+    profile_slot.release()
+
 # --- ROUTES ---
 
+@app.route('/profile', methods=['GET', 'POST'])
+def profile_requests():
+    # POST {"requests": N} profiles the next N requests and writes the aggregate to PROFILE_FILE
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    if request.method == 'POST':
+        try: count = int((request.json or {}).get('requests', 10))
+        except (TypeError, ValueError): return jsonify({"error": "requests must be a number"}), 400
+        if count < 1: return jsonify({"error": "requests must be positive"}), 400
+        with profile_state_lock:
+            profile_state.update({'remaining': count, 'profiled': 0, 'stats': None})
+    with profile_state_lock:
+        return jsonify({"remaining": profile_state['remaining'], "profiled": profile_state['profiled'],
+                        "file": PROFILE_FILE})
+
 @app.route('/server_stats', methods=['GET'])
 def server_stats():
     try:
@@ -85,6 +416,12 @@ def server_stats():
         return jsonify({"cpu": cpu, "ram": ram})
     except: return jsonify({"cpu": 0, "ram": 0})
 
+@app.route('/api_stats', methods=['GET'])
+def outline_api_stats():
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    with inflight_lock:
+        return jsonify(dict(api_stats, in_flight=len(inflight_gets)))
+
 @app.route('/add', methods=['POST'])
 def add_user():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
@@ -116,18 +453,18 @@ def add_user():
     if not new_key: return jsonify({"error": "Outline API Error"}), 500
     key_id = new_key['id']
     
-    # 2. Configure Key
-    call_api('PUT', f'access-keys/{key_id}/name', {'name': name})
-    if limit_bytes > 0:
-        call_api('PUT', f'access-keys/{key_id}/data-limit', {'limit': {'bytes': limit_bytes}})
-
-    # 3. DB Insert (Only if API succeeded)
+    # 2. DB Insert (Only if API succeeded) + queue key configuration for the outbox worker
     token = generate_token()
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?)", 
               (token, key_id, name, expiry_date, status, limit_bytes, duration))
+    enqueue_outbox(c, key_id, 'name', {'name': name})
+    if limit_bytes > 0:
+        enqueue_outbox(c, key_id, 'data_limit', {'bytes': limit_bytes})
     conn.commit()
+    outbox_wakeup.set()
+    snapshot_wakeup.set()
     conn.close()
 
     safe_name = urllib.parse.quote(name)
@@ -142,7 +479,7 @@ def renew_user():
     add_gb = request.json.get('gb')
     add_duration = request.json.get('duration')
 
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id, expiry_date, data_limit, status FROM users WHERE token=?", (token,))
     user = c.fetchone()
@@ -182,28 +519,145 @@ def renew_user():
              limit_changed = True
         except ValueError: pass 
 
-    # 1. API CALL
-    api_ok = True
-    if limit_changed:
-        if new_limit == 0:
-            api_ok = call_api('DELETE', f'access-keys/{key_id}/data-limit') is not None
-        else:
-            api_ok = call_api('PUT', f'access-keys/{key_id}/data-limit', {'limit': {'bytes': new_limit}}) is not None
-
-    if not api_ok:
-        conn.close()
-        return jsonify({"error": "API Error"}), 502
-
-    # 2. DB UPDATE
+    # DB UPDATE + queued Outline limit change
     c.execute("UPDATE users SET expiry_date=?, data_limit=?, status='active' WHERE token=?", (new_expiry, new_limit, token))
+    # Renewing also lifts a suspension, so the 1-byte cap must be replaced too
+    if limit_changed or status == 'suspended':
+        enqueue_outbox(c, key_id, 'data_limit', {'bytes': new_limit or 0})
     conn.commit()
+    outbox_wakeup.set()
+    snapshot_wakeup.set()
     conn.close()
     return jsonify({"status": "Renewed", "new_expiry": new_expiry})
 
+@app.route('/renew_many', methods=['POST'])
+def renew_many():
+    # Select by any combination of "tokens" (list), "prefix" (case-sensitive name prefix) and "status";
+    # "dry_run": true only reports how many users would be renewed
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    data = request.json or {}
+    tokens = data.get('tokens')
+    prefix = data.get('prefix')
+    status = data.get('status')
+    add_gb = str(data.get('gb') or '').strip()
+    add_duration = str(data.get('duration') or '').strip().lower()
+
+    where, params = [], {}
+    if tokens:
+        if not isinstance(tokens, list): return jsonify({"error": "tokens must be a list"}), 400
+        for i, t in enumerate(tokens): params[f"t{i}"] = str(t)
+        where.append(f"token IN ({', '.join(':t%d' % i for i in range(len(tokens)))})")
+    if prefix:
+        if not isinstance(prefix, str): return jsonify({"error": "prefix must be a string"}), 400
+        params['prefix'] = prefix
+        # Exact-case match: a mutating selector must not pick up 'SHOP_1' for batch 'shop_'
+        where.append("substr(name, 1, length(:prefix)) = :prefix")
+    if status:
+        if not isinstance(status, str) or status not in USER_STATUSES: return jsonify({"error": "Invalid status"}), 400
+        params['status'] = status
+        where.append("status = :status")
+    if not where: return jsonify({"error": "No selection (tokens, prefix or status)"}), 400
+    if not add_gb and not add_duration: return jsonify({"error": "Nothing to renew"}), 400
+    where_sql = ' AND '.join(where)
+
+    # Same rules as /renew, evaluated by SQLite for every selected row
+    expiry_sql = "expiry_date"
+    if add_duration == '0':
+        params['unlimited'] = UNLIMITED_EXPIRY
+        expiry_sql = ":unlimited"
+    elif add_duration:
+        hours = duration_to_hours(add_duration)
+        if hours is None: return jsonify({"error": "Invalid duration format"}), 400
+        params['now'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        params['shift'] = f"+{hours} hours"
+        expiry_sql = '''CASE WHEN status = 'on_hold' OR expiry_date IS NULL OR datetime(expiry_date) IS NULL
+                                  OR substr(expiry_date, 1, 4) > '2090' OR expiry_date < :now
+                             THEN datetime(:now, :shift) ELSE datetime(expiry_date, :shift) END'''
+
+    limit_sql = "data_limit"
+    if add_gb == '0':
+        limit_sql = "0"
+    elif add_gb:
+        try: params['add_bytes'] = int(float(add_gb) * 1000 * 1000 * 1000)
+        except (ValueError, OverflowError): return jsonify({"error": "Invalid GB format"}), 400
+        limit_sql = "CASE WHEN COALESCE(data_limit, 0) = 0 THEN :add_bytes ELSE data_limit + :add_bytes END"
+
+    conn = db_connect()
+    c = conn.cursor()
+    if data.get('dry_run'):
+        c.execute(f"SELECT COUNT(*) FROM users WHERE {where_sql}", params)
+        matched = c.fetchone()[0]
+        conn.close()
+        return jsonify({"status": "Dry Run", "count": matched})
+    # Queue the new limits (and lift suspensions) before the rows are rewritten
+    c.execute(f'''INSERT INTO outbox (key_id, op, payload)
+                  SELECT key_id, 'data_limit', json_object('bytes', COALESCE({limit_sql}, 0)) FROM users
+                  WHERE {where_sql} AND (:limit_changed OR status = 'suspended')''',
+              dict(params, limit_changed=bool(add_gb)))
+    c.execute(f"UPDATE users SET expiry_date = {expiry_sql}, data_limit = {limit_sql}, status = 'active' WHERE {where_sql}",
+              params)
+    renewed = c.rowcount
+    conn.commit()
+    outbox_wakeup.set()
+    snapshot_wakeup.set()
+    conn.close()
+    return jsonify({"status": "Renewed", "count": renewed})
+
+@app.route('/search', methods=['GET'])
+def search_users():
+    # ?q=<name or token>&mode=prefix|contains&status=...&expires_within=7d&expired=1&page=1&per_page=20
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    args = request.args
+    q = args.get('q', '').strip()
+    mode = args.get('mode', 'prefix')
+    status = args.get('status')
+    expires_within = args.get('expires_within')
+    try:
+        page = max(1, int(args.get('page', 1)))
+        per_page = min(SEARCH_MAX_PAGE_SIZE, max(1, int(args.get('per_page', SEARCH_PAGE_SIZE))))
+    except ValueError: return jsonify({"error": "Invalid page"}), 400
+
+    where, params = [], {}
+    if q:
+        if mode not in ('prefix', 'contains'): return jsonify({"error": "Invalid mode"}), 400
+        # Prefix search is served by idx_users_name; substring search has to scan the names
+        params['pattern'] = ('' if mode == 'prefix' else '%') + like_escape(q) + '%'
+        params['q'] = q
+        where.append("(name LIKE :pattern ESCAPE '\\' OR token = :q)")
+    if status:
+        if status not in USER_STATUSES: return jsonify({"error": "Invalid status"}), 400
+        params['status'] = status
+        where.append("status = :status")
+    now = datetime.datetime.now()
+    params['now'] = now.strftime('%Y-%m-%d %H:%M:%S')
+    if expires_within:
+        hours = duration_to_hours(expires_within)
+        if hours is None: return jsonify({"error": "Invalid duration format"}), 400
+        params['until'] = (now + datetime.timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+        where.append("status != 'on_hold' AND expiry_date >= :now AND expiry_date <= :until")
+    if args.get('expired') in ('1', 'true', 'yes'):
+        where.append("status != 'on_hold' AND expiry_date < :now")
+    where_sql = ('WHERE ' + ' AND '.join(where)) if where else ''
+
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(f"SELECT COUNT(*) FROM users {where_sql}", params)
+    total = c.fetchone()[0]
+    c.execute(f'''SELECT name, token, status, expiry_date, data_limit FROM users {where_sql}
+                  ORDER BY name COLLATE NOCASE, token LIMIT :limit OFFSET :offset''',
+              dict(params, limit=per_page, offset=(page - 1) * per_page))
+    rows = c.fetchall()
+    conn.close()
+
+    users = [{"name": name, "token": token, "status": st, "expiry": expiry, "data_limit": limit,
+              "is_expired": st != 'on_hold' and bool(expiry) and expiry < params['now']}
+             for name, token, st, expiry, limit in rows]
+    return jsonify({"total": total, "page": page, "per_page": per_page, "users": users})
+
 @app.route('/list_users', methods=['GET'])
 def list_users():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT name, token, expiry_date, key_id, status, initial_duration, data_limit FROM users")
     db_users = c.fetchall()
@@ -257,6 +711,7 @@ def list_users():
     if updated_users:
         c.executemany("UPDATE users SET status='active', expiry_date=? WHERE token=?", updated_users)
         conn.commit()
+        snapshot_wakeup.set()
     conn.close()
     return jsonify(user_list)
 
@@ -264,54 +719,63 @@ def list_users():
 def suspend_user():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
     token = request.json.get('token')
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id FROM users WHERE token=?", (token,))
     res = c.fetchone()
     if res:
         key_id = res[0]
-        # API First
-        if call_api('PUT', f'access-keys/{key_id}/data-limit', {'limit': {'bytes': 1}}):
-            c.execute("UPDATE users SET status='suspended' WHERE token=?", (token,))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "Suspended"})
-        else:
-            conn.close()
-            return jsonify({"error": "API Error"}), 502
+        c.execute("UPDATE users SET status='suspended' WHERE token=?", (token,))
+        enqueue_outbox(c, key_id, 'data_limit', {'bytes': 1})
+        conn.commit()
+        outbox_wakeup.set()
+        snapshot_wakeup.set()
+        conn.close()
+        return jsonify({"status": "Suspended"})
+    conn.close()
     return jsonify({"error": "Not Found"}), 404
 
 @app.route('/unsuspend', methods=['POST'])
 def unsuspend_user():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
     token = request.json.get('token')
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id, data_limit FROM users WHERE token=?", (token,))
     res = c.fetchone()
     if res:
         key_id, original_limit = res
-        api_success = False
-        # API First
-        if original_limit == 0: 
-            if call_api('DELETE', f'access-keys/{key_id}/data-limit'): api_success = True
-        else: 
-            if call_api('PUT', f'access-keys/{key_id}/data-limit', {'limit': {'bytes': original_limit}}): api_success = True
-        
-        if api_success:
-            c.execute("UPDATE users SET status='active' WHERE token=?", (token,))
-            conn.commit()
-            conn.close()
-            return jsonify({"status": "Active"})
-        else:
-            conn.close()
-            return jsonify({"error": "API Error"}), 502
+        c.execute("UPDATE users SET status='active' WHERE token=?", (token,))
+        enqueue_outbox(c, key_id, 'data_limit', {'bytes': original_limit or 0})
+        conn.commit()
+        outbox_wakeup.set()
+        snapshot_wakeup.set()
+        conn.close()
+        return jsonify({"status": "Active"})
+    conn.close()
     return jsonify({"error": "Not Found"}), 404
 
+@app.route('/outbox', methods=['GET'])
+def outbox_status():
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*), COALESCE(MAX(attempts), 0), COUNT(*) - COUNT(next_attempt) FROM outbox")
+    pending, max_attempts, dead = c.fetchone()
+    c.execute("SELECT key_id, op, attempts, last_error, next_attempt IS NULL FROM outbox WHERE attempts > 0 ORDER BY id LIMIT 20")
+    failing = [{"key_id": k, "op": op, "attempts": a, "error": e, "dead": bool(d)} for k, op, a, e, d in c.fetchall()]
+    conn.close()
+    return jsonify({"pending": pending, "dead": dead, "max_attempts": max_attempts, "failing": failing})
+
+@app.route('/snapshot', methods=['GET'])
+def snapshot_status():
+    if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
+    return jsonify(dict(snapshot_state, enabled=bool(load_config().get('sub_snapshot'))))
+
 @app.route('/clean_expired', methods=['POST'])
 def clean_expired():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id, expiry_date, name FROM users WHERE status='active'")
     users = c.fetchall()
@@ -324,12 +788,14 @@ def clean_expired():
                 exp_date = datetime.datetime.strptime(expiry_str, '%Y-%m-%d %H:%M:%S')
                 if now > exp_date:
                     # API First
-                    if call_api('DELETE', f'access-keys/{key_id}'):
+                    if call_api('DELETE', f'access-keys/{key_id}') is not None:
                          c.execute("DELETE FROM users WHERE key_id=?", (key_id,))
+                         c.execute("DELETE FROM outbox WHERE key_id=?", (key_id,))
                          deleted_count += 1
         except: continue
     conn.commit()
     conn.close()
+    if deleted_count: snapshot_wakeup.set()
     return jsonify({"deleted": deleted_count})
 
 @app.route('/delete_user', methods=['POST'])
@@ -337,7 +803,7 @@ def delete_user():
     if not check_local_access(): return jsonify({"error": "Access Denied"}), 403
     token = request.json.get('token')
     if not token: return jsonify({"error": "Empty Token"}), 400
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id FROM users WHERE token=?", (token,))
     res = c.fetchone()
@@ -347,7 +813,9 @@ def delete_user():
         api_result = call_api('DELETE', f'access-keys/{key_id}')
         if api_result is not None:
             c.execute("DELETE FROM users WHERE token=?", (token,))
+            c.execute("DELETE FROM outbox WHERE key_id=?", (key_id,))
             conn.commit()
+            snapshot_wakeup.set()
             conn.close()
             return jsonify({"status": "Deleted"})
         else:
@@ -360,7 +828,7 @@ def delete_user():
 def get_sub(token):
     # Public Access
     conf = load_config()
-    conn = sqlite3.connect(DB_FILE)
+    conn = db_connect()
     c = conn.cursor()
     c.execute("SELECT key_id, expiry_date, name, status FROM users WHERE token=?", (token,))
     user = c.fetchone()
@@ -380,29 +848,15 @@ def get_sub(token):
     target_key = next((k for k in keys['accessKeys'] if k['id'] == key_id), None)
     if not target_key: return "Key Not Found", 404
 
-    original_url = target_key['accessUrl']
-    base = original_url.split('?')[0]
-    # Regex Fix: Removed space in group name (?P<u > -> ?P<u>)
-    match = re.match(r'ss://(?P<u>[^@]+)@(?P<h>[^:]+):(?P<p>\d+)', base)
-    
-    final_response_text = original_url 
-    if match:
-        final_port = conf['force_port'] if conf['force_port'] else match.group('p')
-        base_suffix = conf['custom_suffix'].split('#')[0]
-        encoded_name = urllib.parse.quote(db_name)
-        final_response_text = f"ss://{match.group('u')}@{conf['tunnel_address']}:{final_port}{base_suffix}#{encoded_name}"
-
-    response = make_response(final_response_text)
+    response = make_response(render_sub_text(conf, target_key['accessUrl'], db_name))
     response.headers['Content-Type'] = 'text/plain; charset=utf-8'
-    
-    # Sanitize Filename for Header Injection Protection
-    safe_filename = re.sub(r'[^\w\-. ]', '', db_name).strip()
-    if not safe_filename:
-        safe_filename = f"outline-{token}"
-    response.headers['Content-Disposition'] = f'inline; filename="{safe_filename}"'
+    response.headers['Content-Disposition'] = f'inline; filename="{sub_filename(db_name, token)}"'
     return response
 
 if __name__ == '__main__':
     init_db()
+    load_trace_settings()
+    start_outbox_worker()
+    if load_config().get('sub_snapshot'): start_snapshot_worker()
     # IPv6/IPv4 Localhost check is implemented in 'check_local_access'
     app.run(host='0.0.0.0', port=5000, debug=False)
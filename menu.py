@@ -20,6 +20,7 @@ API_URL = "http://127.0.0.1:5000"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json')
 SERVICE_NAME = "outline-manager"
+PAGE_SIZE = 20
 
 def clear():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -211,35 +212,87 @@ def list_users(sort_by_usage=False):
     except Exception as e: print(f"{RED}Error: {e}{RESET}")
     get_validated_input("\nPress Enter...", allow_empty=True)
 
+def search_users(query="", page=1, per_page=PAGE_SIZE):
+    try:
+        res = requests.get(f"{API_URL}/search", params={"q": query, "page": page, "per_page": per_page})
+        if res.status_code == 200: return res.json()
+        print(f"{RED}Error: {res.text}{RESET}")
+    except Exception as e: print(f"{RED}Service Error: {e}{RESET}")
+    return None
+
+def print_page_footer(data):
+    pages = max(1, -(-data['total'] // data['per_page']))
+    print(f"{CYAN}Page {data['page']}/{pages} ({data['total']} matches){RESET}")
+    return pages
+
+def pick_user():
+    query = get_validated_input("Search name/token: ")
+    if query is None: return None
+    page = 1
+    while True:
+        data = search_users(query, page)
+        if data is None: return None
+        users = data['users']
+        if not users:
+            print(f"{RED}No users found.{RESET}")
+            return None
+        print(f"\n{'#':<4} {'NAME':<15} {'TOKEN':<12} {'TIME LEFT':<12}")
+        print("-" * 45)
+        for idx, u in enumerate(users):
+            print(f"{CYAN}{idx+1:<4}{RESET} {u['name']:<15} {u['token']:<12} {calculate_time_left(u['expiry'], u['status']):<12}")
+        pages = print_page_footer(data)
+        if len(users) == 1 and pages == 1:
+            confirm = get_validated_input(f"Use {users[0]['name']}? (y/n): ", validator=is_valid_yes_no)
+            return users[0] if confirm and confirm.lower() in ['y', 'yes'] else None
+
+        sel = get_validated_input(f"{BOLD}Select # ('n'/'p' to change page) > {RESET}")
+        if sel is None: return None
+        if sel.lower() == 'n' and page < pages: page += 1
+        elif sel.lower() == 'p' and page > 1: page -= 1
+        elif sel.isdigit() and 1 <= int(sel) <= len(users): return users[int(sel) - 1]
+        else: print(f"{RED}Invalid selection.{RESET}")
+
 def delete_user_menu():
     print_header()
     print(f"{YELLOW}[ Advanced Delete Users ]{RESET}")
-    try:
-        res = requests.get(f"{API_URL}/list_users")
-        if res.status_code != 200: return
-        users = res.json()
-    except: return
+    query = get_validated_input("Search name/token (empty for all): ", allow_empty=True)
+    if query is None: return
 
-    if not users:
-        print(f"{RED}No users found.{RESET}")
-        time.sleep(2)
-        return
+    page = 1
+    while True:
+        data = search_users(query, page)
+        if data is None: return
+        users = data['users']
+        if not users:
+            print(f"{RED}No users found.{RESET}")
+            time.sleep(2)
+            return
 
-    print(f"{'#':<4} {'NAME':<15} {'TOKEN':<12}")
-    print("-" * 35)
-    for idx, u in enumerate(users):
-        print(f"{CYAN}{idx+1:<4}{RESET} {u['name']:<15} {u['token']:<12}")
-    
-    print("-" * 35)
-    print(f"{YELLOW}Enter numbers (e.g. 1, 3-5, all) or 'c' to cancel{RESET}")
-    
-    selection = get_validated_input(f"{BOLD}Select > {RESET}")
-    if selection is None: return
+        print(f"{'#':<4} {'NAME':<15} {'TOKEN':<12}")
+        print("-" * 35)
+        for idx, u in enumerate(users):
+            print(f"{CYAN}{idx+1:<4}{RESET} {u['name']:<15} {u['token']:<12}")
+        
+        print("-" * 35)
+        pages = print_page_footer(data)
+        print(f"{YELLOW}Enter numbers (e.g. 1, 3-5, all), 'n'/'p' to change page or 'c' to cancel{RESET}")
+        
+        selection = get_validated_input(f"{BOLD}Select > {RESET}")
+        if selection is None: return
+        if selection.lower() == 'n' and page < pages: page += 1
+        elif selection.lower() == 'p' and page > 1: page -= 1
+        elif selection.lower() not in ['n', 'p']: break
 
     indexes_to_delete = []
     if selection.lower() == 'all':
-        confirm_all = get_validated_input(f"{RED}Delete ALL? (yes/no): {RESET}", validator=is_valid_yes_no)
+        confirm_all = get_validated_input(f"{RED}Delete ALL {data['total']} matches? (yes/no): {RESET}", validator=is_valid_yes_no)
         if confirm_all and confirm_all.lower() in ['yes', 'y']:
+            # Collect every page first, deleting while paging would shift the results
+            users = []
+            for p in range(1, pages + 1):
+                chunk = search_users(query, p)
+                if chunk is None: return
+                users.extend(chunk['users'])
             indexes_to_delete = list(range(len(users)))
         else: return
     else:
@@ -278,6 +331,7 @@ def manage_user_actions():
     print("2. Suspend User")
     print("3. Unsuspend User")
     print("4. Clean Expired Users")
+    print("5. Bulk Renew / Extend")
     
     action = get_validated_input(f"\n{CYAN}Select Action (or 'c' to cancel): {RESET}")
     if action is None: return
@@ -290,8 +344,15 @@ def manage_user_actions():
         time.sleep(2)
         return
 
-    token = get_validated_input("Enter User Token: ")
-    if token is None: return
+    if action == '5':
+        bulk_renew_users()
+        return
+
+    user = pick_user()
+    if user is None:
+        time.sleep(1)
+        return
+    token = user['token']
 
     if action == '1': 
         print(f"{CYAN}Leave empty to skip.{RESET}")
@@ -321,6 +382,60 @@ def manage_user_actions():
         else: print(f"{RED}Failed: {res.text}{RESET}")
     time.sleep(1.5)
 
+def bulk_renew_users():
+    print(f"\n{YELLOW}[ Bulk Renew ]{RESET}")
+    print("1. By Bulk Batch (base name used in Bulk Create)")
+    print("2. By Token List")
+    print("3. By Status")
+    mode = get_validated_input(f"{CYAN}Select: {RESET}", validator=lambda x: x in ['1', '2', '3'], error_msg="1, 2 or 3")
+    if mode is None: return
+
+    payload = {}
+    if mode == '1':
+        base_name = get_validated_input("Batch Base Name: ")
+        if base_name is None: return
+        payload['prefix'] = f"{base_name}_"  # Bulk Create names users '<base>_<i>'
+    elif mode == '2':
+        tokens = get_validated_input("Tokens (comma separated): ")
+        if tokens is None: return
+        payload['tokens'] = [t.strip() for t in tokens.split(',') if t.strip()]
+    else:
+        status = get_validated_input("Status (active/on_hold/suspended): ",
+                                     validator=lambda x: x in ['active', 'on_hold', 'suspended'])
+        if status is None: return
+        payload['status'] = status
+
+    print(f"{CYAN}Leave empty to skip.{RESET}")
+    add_gb = get_validated_input("Add GB: ", allow_empty=True, validator=is_valid_number, error_msg="Number only")
+    if add_gb is None: return
+    print(f"{CYAN}(Format: 30d, 5h){RESET}")
+    add_time = get_validated_input("Extend Time: ", allow_empty=True,
+                                   validator=lambda x: is_valid_duration(x) if x else True)
+    if add_time is None: return
+    if not add_gb and not add_time: return
+    if add_gb: payload['gb'] = add_gb
+    if add_time: payload['duration'] = add_time
+
+    try:
+        res = requests.post(f"{API_URL}/renew_many", json=dict(payload, dry_run=True))
+        if res.status_code != 200:
+            print(f"{RED}Failed: {res.text}{RESET}")
+            get_validated_input("\nPress Enter...", allow_empty=True)
+            return
+        matched = res.json()['count']
+        if not matched:
+            print(f"{RED}No users found.{RESET}")
+            time.sleep(2)
+            return
+        confirm = get_validated_input(f"{YELLOW}Renew {matched} users? (y/n): {RESET}", validator=is_valid_yes_no)
+        if not confirm or confirm.lower() not in ['y', 'yes']: return
+
+        res = requests.post(f"{API_URL}/renew_many", json=payload)
+        if res.status_code == 200: print(f"{GREEN}✔ Renewed {res.json()['count']} users.{RESET}")
+        else: print(f"{RED}Failed: {res.text}{RESET}")
+    except Exception as e: print(f"{RED}Service Error: {e}{RESET}")
+    get_validated_input("\nPress Enter...", allow_empty=True)
+
 def edit_config():
     print_header()
     try:
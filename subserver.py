@@ -0,0 +1,155 @@
+# Read-only subscription responder.
+# Serves GET /getsub/<token> from the snapshot index written by manager.py (config: "sub_snapshot": true)
+# without Flask or SQLite. Run several workers on one port, or copy the index to replica nodes:
+#   python3 subserver.py --port 5001 --workers 4 [--index /opt/outline-manager/subs.idx]
+import os
+import re
+import sys
+import time
+import mmap
+import struct
+import socket
+import argparse
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = os.path.join(BASE_DIR, 'subs.idx')
+
+# Layout (little-endian): header, fixed-size entry table sorted by token, then a string blob.
+#   header: magic, version, entry count
+#   entry:  token_off, token_len, code, expiry (unix time, 0 = none), body_off, body_len, fname_off, fname_len
+MAGIC = b'OMSUBIDX'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+ENTRY = struct.Struct('<IHBxqIIIH')
+
+SUB_ACTIVE = 0
+SUB_ON_HOLD = 1
+SUB_SUSPENDED = 2
+SUB_KEY_MISSING = 3
+
+def write_index(path, entries):
+    # entries: iterable of (token, code, expiry_ts, body, filename); replaced atomically
+    rows = sorted((t.encode(), code, int(exp or 0), body.encode(), fname.encode())
+                  for t, code, exp, body, fname in entries)
+    table_end = HEADER.size + ENTRY.size * len(rows)
+    table, blob = [], bytearray()
+
+    def put(data):
+        blob.extend(data)
+        return table_end + len(blob) - len(data)
+
+    for token, code, exp, body, fname in rows:
+        token_off = put(token)
+        body_off = put(body)
+        fname_off = put(fname)
+        table.append(ENTRY.pack(token_off, len(token), code, exp, body_off, len(body), fname_off, len(fname)))
+
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(rows)))
+        f.write(b''.join(table))
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(rows)
+
+class SubIndex:
+    # Memory-maps the index and re-opens it when manager.py swaps in a new file
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.current = None  # (mmap, entry count), swapped as one reference
+
+    def refresh(self):
+        try: st = os.stat(self.path)
+        except OSError: return False
+        version = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if version == self.version: return self.current is not None
+        try:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, file_version, count = HEADER.unpack_from(mm, 0)
+        except (OSError, ValueError, struct.error): return self.current is not None
+        if magic != MAGIC or file_version != VERSION:
+            mm.close()
+            return self.current is not None
+        self.current, self.version = (mm, count), version  # Old map is released once unreferenced
+        return True
+
+    def lookup(self, token):
+        if not self.refresh(): return None
+        mm, count = self.current
+        key = token.encode()
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = ENTRY.unpack_from(mm, HEADER.size + mid * ENTRY.size)
+            cur = mm[entry[0]:entry[0] + entry[1]]
+            if cur < key: lo = mid + 1
+            elif cur > key: hi = mid
+            else:
+                _, _, code, exp, body_off, body_len, fname_off, fname_len = entry
+                return code, exp, mm[body_off:body_off + body_len], mm[fname_off:fname_off + fname_len].decode()
+        return None
+
+def resolve(index, token):
+    # Same answers as manager.get_sub: (status, body, filename)
+    found = index.lookup(token)
+    if found is None: return 404, b"Invalid Link", None
+    code, expiry, body, filename = found
+    if code == SUB_SUSPENDED: return 403, b"Account Suspended", None
+    if code != SUB_ON_HOLD and expiry and time.time() > expiry: return 403, b"Expired", None
+    if code == SUB_KEY_MISSING: return 404, b"Key Not Found", None
+    return 200, body, filename
+
+class SubHandler(BaseHTTPRequestHandler):
+    index = None
+
+    def do_GET(self):
+        match = re.match(r'^/getsub/([^/?#]+)', self.path)
+        if not match:
+            status, body, filename = 404, b"Not Found", None
+        else:
+            status, body, filename = resolve(self.index, urllib.parse.unquote(match.group(1)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if filename: self.send_header('Content-Disposition', f'inline; filename="{filename}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): pass
+
+class SubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Lets several worker processes (or a restart) share the port
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def serve(host, port, index_path):
+    SubHandler.index = SubIndex(index_path)
+    SubServer((host, port), SubHandler).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Read-only Outline subscription server")
+    parser.add_argument('--index', default=INDEX_FILE)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit("--workers needs SO_REUSEPORT support")
+    for _ in range(args.workers - 1):
+        if os.fork() == 0: break
+    try: serve(args.host, args.port, args.index)
+    except KeyboardInterrupt: pass
+
+if __name__ == '__main__':
+    main()